@@ -36,25 +36,32 @@ import numpy as np
 import pandas as pd
 import re
 
+# Label columns are always strings, so skip per-file type inference for them
+_LABEL_DTYPES = {
+    'experiment_id': str,
+    'policy': str,
+    'custom_policy': str,
+    'custom_policy_msg': str,
+}
+_RPS_RE = re.compile(r'rps=(.+?),')
+
 def read_e2e_csv_metrics(fpaths: List[str]):
     if isinstance(fpaths, str):
         fpaths = [fpaths]
-    dataframes = [pd.read_csv(file) for file in fpaths]
+    dataframes = [pd.read_csv(file, dtype=_LABEL_DTYPES) for file in fpaths]
     combined_df = pd.concat(dataframes, ignore_index=True)
 
-    # Function to extract rps from the experiment_id column
-    def extract_rps(experiment_id):
-        match = re.search(r'rps=(.+?),', experiment_id)
-        return float(match.group(1)) if match else None
-    
-    # Apply the function to the experiment_id column and create a new column for rps
+    # Extract rps from the experiment_id column and create a new column for it
     if 'rps' not in combined_df.columns:
-        combined_df['rps'] = combined_df['experiment_id'].apply(extract_rps)
+        combined_df['rps'] = combined_df['experiment_id'].str.extract(_RPS_RE, expand=False).astype(float)
 
     combined_df.fillna({'custom_policy': ''}, inplace=True)
     combined_df.fillna({'custom_policy_msg': ''}, inplace=True)
 
     # print(combined_df[['experiment_id', 'rps']])
     combined_df = combined_df.sort_values(by='rps')
-    grouped = combined_df.groupby(['policy', 'custom_policy'])
+    # Categorical keys group on integer codes instead of hashing strings
+    combined_df['policy'] = combined_df['policy'].astype('category')
+    combined_df['custom_policy'] = combined_df['custom_policy'].astype('category')
+    grouped = combined_df.groupby(['policy', 'custom_policy'], observed=True)
     return grouped
\ No newline at end of file
@@ -36,6 +36,8 @@ class TreeNode:
         self.decode_length = deque()
         self.context_length = 0
         self.depth = 0
+        # Nearest large ancestor-or-self, filled in lazily by the global scheduler
+        self.important_node: Optional[TreeNode] = None
 
     def has_cached_gpu(self, gpu):
         return gpu in self.cached_gpus and gpu not in self.evicted_gpus
@@ -1,14 +1,13 @@
 from collections import defaultdict
-from datetime import datetime, timedelta
 from benchmarks.benchmark_utils import RequestFuncOutput
 from global_lru_cache import LPRadixCache, TreeNode
 import time
+import random
 import numpy as np
 import threading
 import heapq
 from collections import deque
-from typing import List, Tuple, Dict
-from transformers import AutoTokenizer
+from typing import List, Tuple, Dict, Deque
 import logging
 import copy
 import math
@@ -16,18 +15,44 @@ from benchmarks.exp_configs.model_equations import LP_mistral_7b_A6000_sglang_ex
 # from benchmarks.exp_configs.model_equations import LP_Llama3_70B_H100_sglang_extend_flashinfer as prefill_time
 from ttft_overload_detector import TTFTWindowedOverloadedDetector
 
-tokenizer = AutoTokenizer.from_pretrained("mistralai/Mistral-7B-v0.1")
+_tokenizer = None
+
+def _get_tokenizer():
+    # Only needed to pretty print the tree, so load it lazily
+    global _tokenizer
+    if _tokenizer is None:
+        from transformers import AutoTokenizer
+        _tokenizer = AutoTokenizer.from_pretrained("mistralai/Mistral-7B-v0.1")
+    return _tokenizer
 
 logger = logging.getLogger(__name__)
 
+_EMPTY_SET = frozenset()
+
 class SlidingWindowHistogram:
-    def __init__(self, window_duration: timedelta, gpu_allocations, num_gpus=2, enable_miss_rate=True,avg_topt_per_gpu=None):
+    __slots__ = (
+        'window_duration', 'gpu_allocations', 'histogram', 'node_to_count', 'timestamps',
+        '_node_alias', '_id_of', '_next_node_id', 'num_gpus', 'enable_miss_rate',
+        'prev_mis_rates', 'hit_tokens', 'prompt_tokens', 'decoding_size',
+        'avg_topt_per_gpu', 'current_prefill_cost_per_gpu',
+        'current_decode_lengths_per_gpu', 'per_node_prefill_cost',
+        'per_node_total_decode_lengths', '_prefill_allocation', '_decode_allocation',
+        '_node_allocation', 'min_load', '_loaded_prefill_allocation',
+        '_loaded_decode_allocation',
+    )
+
+    def __init__(self, window_duration: float, gpu_allocations, num_gpus=2, enable_miss_rate=True,avg_topt_per_gpu=None):
         self.window_duration = window_duration
         self.gpu_allocations = gpu_allocations
         self.histogram = defaultdict(int)
         self.node_to_count = defaultdict(int)
 
-        self.timestamps: List[Tuple[datetime, TreeNode, TreeNode]] = []
+        self.timestamps: Deque[Tuple[float, int, TreeNode]] = deque()
+        # Timestamps reference important nodes by a stable id so a split only
+        # needs to repoint the id instead of rewriting the whole window
+        self._node_alias: Dict[int, TreeNode] = {}
+        self._id_of: Dict[TreeNode, int] = {}
+        self._next_node_id = 0
         self.num_gpus = num_gpus
         self.enable_miss_rate = enable_miss_rate
         self.prev_mis_rates = {}
@@ -41,6 +66,16 @@ class SlidingWindowHistogram:
         self.per_node_prefill_cost = defaultdict(int)
         self.per_node_total_decode_lengths = defaultdict(int)
 
+        # Running per-gpu totals behind current_allocation_per_gpu. The decode
+        # part is kept in tokens and scaled by the current tpot on query.
+        self._prefill_allocation = [0 for i in range(self.num_gpus)]
+        self._decode_allocation = [0 for i in range(self.num_gpus)]
+        self._node_allocation: Dict[TreeNode, Tuple[float, Dict[int, float], bool]] = {}
+        # Same totals restricted to nodes seen at least min_load times in the window
+        self.min_load = 2
+        self._loaded_prefill_allocation = [0 for i in range(self.num_gpus)]
+        self._loaded_decode_allocation = [0 for i in range(self.num_gpus)]
+
     @property
     def current_allocation_cost_per_gpu(self):
         costs = []
@@ -50,7 +85,7 @@ class SlidingWindowHistogram:
         return costs
 
     def update(self, timestamp, node: TreeNode, leaf_node: TreeNode, runtime_idx, decoding_length):
-        self.timestamps.append((timestamp, node, leaf_node))
+        self.timestamps.append((timestamp, self._get_node_id(node), leaf_node))
         self.histogram[node] += 1 * leaf_node.context_length
         self.node_to_count[node] += 1
         self.decoding_size[node] = decoding_length
@@ -64,6 +99,7 @@ class SlidingWindowHistogram:
 
         self.update_prefill_cost_per_node(node, runtime_idx)
         self.current_decode_lengths_per_gpu[runtime_idx] += decoding_length
+        self.refresh_node_allocation(node)
 
     def update_prefill_cost_per_node(self, node, runtime_idx):
         if runtime_idx not in self.gpu_allocations.get(node) or node not in self.prev_mis_rates or node not in self.node_to_count:
@@ -74,10 +110,23 @@ class SlidingWindowHistogram:
         self.current_prefill_cost_per_gpu[runtime_idx] += new_cost
         self.per_node_prefill_cost[node] = new_cost
 
+    def _get_node_id(self, node):
+        node_id = self._id_of.get(node)
+        if node_id is None:
+            node_id = self._next_node_id
+            self._next_node_id += 1
+            self._id_of[node] = node_id
+            self._node_alias[node_id] = node
+        return node_id
+
     def _remove_old_entries(self, current_timestamp):
+        timestamps = self.timestamps
         window_start = current_timestamp - self.window_duration
-        while self.timestamps and self.timestamps[0][0] < window_start:
-            timestamp, node, leaf_node = self.timestamps.pop(0)
+        if not timestamps or timestamps[0][0] >= window_start:
+            return # common case, nothing has expired yet
+        while timestamps and timestamps[0][0] < window_start:
+            timestamp, node_id, leaf_node = timestamps.popleft()
+            node = self._node_alias[node_id]
             self.histogram[node] -= 1 * leaf_node.context_length
             self.node_to_count[node] -= 1
             self.hit_tokens[node] -= leaf_node.context_length - leaf_node.num_tokens
@@ -93,7 +142,9 @@ class SlidingWindowHistogram:
                 del self.hit_tokens[node]
                 del self.prompt_tokens[node]
                 del self.decoding_size[node]
+                del self._node_alias[self._id_of.pop(node)]
                 self.gpu_allocations[node] = set() # Reset the gpu allocation outside the time window
+            self.refresh_node_allocation(node)
 
     def rename_node(self, old_node, new_node):
         if old_node in self.histogram:
@@ -111,49 +162,94 @@ class SlidingWindowHistogram:
                 self.per_node_prefill_cost[old_node] = 0
                 self.update_prefill_cost_per_node(new_node, gpu)
 
-            timestamps = []
-            for timestamp, important_node, leaf_node in self.timestamps:
-                if important_node == old_node:
-                    important_node = new_node
-                timestamps.append((timestamp, important_node, leaf_node))
-            self.timestamps = timestamps
+            node_id = self._id_of.pop(old_node)
+            self._node_alias[node_id] = new_node
+            self._id_of[new_node] = node_id
+
+            self.refresh_node_allocation(old_node)
+            self.refresh_node_allocation(new_node)
 
     def query(self):
         return dict(self.histogram)
 
     def current_allocation_per_gpu(self):
-        allocation = [0 for _ in range(self.num_gpus)]
-        topts = []
+        allocation = []
         for i in range(self.num_gpus):
-            topts.append(np.median(self.avg_topt_per_gpu[i]))
-        node: TreeNode
-        for node, cost in self.histogram.items():
-            for gpu in self.gpu_allocations.get(node, {}):
-                allocation[gpu] += self.get_node_cost(node, gpu, topts[gpu])
+            topt = np.median(self.avg_topt_per_gpu[i])
+            allocation.append(self._prefill_allocation[i] + self._decode_allocation[i] * topt)
         return allocation
 
+    def refresh_node_allocation(self, node: TreeNode):
+        """Replace the node's share of the running per-gpu allocation with its current cost."""
+        prev = self._node_allocation.pop(node, None)
+        if prev is not None:
+            prefill_cost, decode_tokens, loaded = prev
+            for gpu, tokens in decode_tokens.items():
+                self._prefill_allocation[gpu] -= prefill_cost
+                self._decode_allocation[gpu] -= tokens
+                if loaded:
+                    self._loaded_prefill_allocation[gpu] -= prefill_cost
+                    self._loaded_decode_allocation[gpu] -= tokens
+        gpus = self.gpu_allocations.get(node)
+        if node not in self.histogram or not gpus:
+            return
+        prefill_cost = self.get_prefill_cost(node)
+        output_len = self.get_output_len(node)
+        loaded = self.node_to_count[node] >= self.min_load
+        decode_tokens = {}
+        for gpu in gpus:
+            tokens = node.ref_counter[gpu] * output_len
+            self._prefill_allocation[gpu] += prefill_cost
+            self._decode_allocation[gpu] += tokens
+            if loaded:
+                self._loaded_prefill_allocation[gpu] += prefill_cost
+                self._loaded_decode_allocation[gpu] += tokens
+            decode_tokens[gpu] = tokens
+        self._node_allocation[node] = (prefill_cost, decode_tokens, loaded)
+
+    def refresh_path_allocation(self, node: TreeNode):
+        # ref counters change along the whole path on schedule and finish
+        while node:
+            if node in self.histogram:
+                self.refresh_node_allocation(node)
+            node = node.parent
+
     def current_allocation_per_gpu_with_atleast_min_load(self, min_load=2):
-        allocation = [0 for _ in range(self.num_gpus)]
         topts = []
         for i in range(self.num_gpus):
             topts.append(np.median(self.avg_topt_per_gpu[i]))
+        if min_load == self.min_load:
+            return [
+                self._loaded_prefill_allocation[i] + self._loaded_decode_allocation[i] * topts[i]
+                for i in range(self.num_gpus)
+            ]
 
+        allocation = [0 for _ in range(self.num_gpus)]
         node: TreeNode
-        for node, cost in self.histogram.items():
-            for gpu in self.gpu_allocations.get(node, {}):
-                if self.node_to_count[node] < min_load:
-                    continue
-                allocation[gpu] += self.get_node_cost(node, gpu, topts[gpu])
+        for node in self.histogram:
+            if self.node_to_count[node] < min_load:
+                continue
+            gpus = self.gpu_allocations.get(node)
+            if not gpus:
+                continue
+            # prefill share and output length do not depend on the gpu
+            prefill_cost = self.get_prefill_cost(node)
+            output_len = self.get_output_len(node)
+            for gpu in gpus:
+                allocation[gpu] += prefill_cost + node.ref_counter[gpu] * output_len * topts[gpu]
         return allocation
     
     def get_prefill_cost(self, node: TreeNode):
         return self.prev_mis_rates[node] * self.node_to_count[node] * prefill_time(node.num_tokens, node.context_length) / len(self.gpu_allocations.get(node)) # potentionally divide by length of node.cached_gpus here
     
+    def get_output_len(self, node: TreeNode):
+        if node.decode_length:
+            return np.median(node.decode_length)
+        return self.decoding_size[node]
+
     def get_node_cost(self, node: TreeNode, gpu, tpot):
         prefill_cost = self.get_prefill_cost(node)
-        output_len = self.decoding_size[node]
-        if node.decode_length:
-            output_len = np.median(node.decode_length)
+        output_len = self.get_output_len(node)
         active_requests = node.ref_counter[gpu]
         decode_cost = active_requests * output_len * tpot
         return prefill_cost + decode_cost
@@ -179,7 +275,15 @@ class SlidingWindowHistogram:
 
 
 class GlobalSchedulerWithTime:
-    def __init__(self, num_nodes=2, enable_eviction=False, enable_rebalancing=True, enable_miss_rate=True) -> None:
+    __slots__ = (
+        'num_gpus', 'gpu_allocations', 'counter', 'enable_eviction', 'per_gpu_load',
+        'all_gpus', 'mem_cost', 'enable_metrics', 'metrics_dict', 'lock', 'enable_miss_rate',
+        'avg_topt_per_gpu', 'histogram', 'cache', 'max_tokens_gpu',
+        'HIGH_LOAD_THRESHOLD', 'REBALANCING_CHAIN_LENGTH', 'overload_detector',
+        'enable_rebalancing', 'last_rebalancing_time', 'min_rebalancing_interval',
+    )
+
+    def __init__(self, num_nodes=2, enable_eviction=False, enable_rebalancing=True, enable_miss_rate=True, enable_metrics=False) -> None:
         self.num_gpus = num_nodes
         self.gpu_allocations = {}
         self.counter = 0
@@ -189,7 +293,9 @@ class GlobalSchedulerWithTime:
 
         self.mem_cost = [0 for _ in range(num_nodes)]
         self.num_gpus = num_nodes
-        self.metrics_dict = []
+        # Bounded so long runs do not keep every request's text alive
+        self.enable_metrics = enable_metrics
+        self.metrics_dict = deque(maxlen=10000)
         self.lock = threading.Lock()
         self.enable_miss_rate = enable_miss_rate
         self.avg_topt_per_gpu = [deque(maxlen=200) for _ in range(num_nodes)] 
@@ -197,7 +303,7 @@ class GlobalSchedulerWithTime:
             self.avg_topt_per_gpu[i].append(.15)
 
         self.histogram = SlidingWindowHistogram(
-            window_duration=timedelta(minutes=3), 
+            window_duration=3 * 60, 
             gpu_allocations=self.gpu_allocations, 
             num_gpus=self.num_gpus, 
             enable_miss_rate=self.enable_miss_rate,
@@ -208,10 +314,10 @@ class GlobalSchedulerWithTime:
         self.HIGH_LOAD_THRESHOLD = 1.5
         self.REBALANCING_CHAIN_LENGTH = 3 # Max rebalancing length for chain. For long chains, don't rebalance to allow infercept to take over
 
-        self.overload_detector = TTFTWindowedOverloadedDetector(window_duration=timedelta(minutes=3))
+        self.overload_detector = TTFTWindowedOverloadedDetector(window_duration=3 * 60)
         self.enable_rebalancing = enable_rebalancing
-        self.last_rebalancing_time = datetime.now()
-        self.min_rebalancing_interval = timedelta(seconds=10)
+        self.last_rebalancing_time = time.monotonic()
+        self.min_rebalancing_interval = 10
         
     # Consider Split nodes
     def handle_split_nodes_gpu_allocations(self, split_nodes, gpu_allocations):
@@ -225,32 +331,36 @@ class GlobalSchedulerWithTime:
                 self.histogram.rename_node(child, parent_node)
                 parent_node.decode_length.extend(child.decode_length)
                 child.decode_length = []
-                for gpu in self.gpu_allocations.get(child, {}):
+                for gpu in self.gpu_allocations.get(child, _EMPTY_SET):
                     self.overload_detector.rename_node(child, parent_node, gpu)
             
             if self.is_large_node(child):
-                for gpu in self.gpu_allocations.get(child, {}):
+                for gpu in self.gpu_allocations.get(child, _EMPTY_SET):
                     self.histogram.update_prefill_cost_per_node(child, gpu)
+            self.histogram.refresh_node_allocation(child)
+            self.histogram.refresh_node_allocation(parent_node)
 
-    # Recursively update get/update parent gpu allocation
+    # Nearest ancestor-or-self with a gpu allocation, all gpus if there is none
     def get_parent_gpu_allocation(self, node: TreeNode):
-        if not node:
-            return self.all_gpus
-        if self.gpu_allocations.get(node):
-            return self.gpu_allocations.get(node)
-        return self.get_parent_gpu_allocation(node.parent)
-
-    def update_gpu_cache_for_parent(self,node: TreeNode, gpu_id):
-        if not node:
-            return
-        node.cached_gpus = node.cached_gpus.union(gpu_id)
-        self.update_cached_gpus_of_parent(node.parent, gpu_id)
+        while node:
+            gpus = self.gpu_allocations.get(node)
+            if gpus:
+                return gpus
+            node = node.parent
+        return self.all_gpus
+
+    def update_gpu_cache_for_parent(self, node: TreeNode, gpu_id):
+        while node:
+            node.cached_gpus.update(gpu_id)
+            node = node.parent
 
     def update_gpu_allocation_for_parent(self, node: TreeNode, gpu_id):
-        if not node:
-            return
-        self.gpu_allocations[node] = self.gpu_allocations.get(node, set()).union(gpu_id)
-        self.update_gpu_allocation_for_parent(node.parent, gpu_id)
+        while node:
+            gpus = self.gpu_allocations.get(node)
+            if gpus is None:
+                gpus = self.gpu_allocations[node] = set()
+            gpus.update(gpu_id)
+            node = node.parent
 
     def is_small_node(self, node: TreeNode):
         return not self.is_large_node(node)
@@ -259,9 +369,15 @@ class GlobalSchedulerWithTime:
         return node.num_tokens > node.context_so_far
 
     def get_important_node(self, node: TreeNode):
-        if self.is_large_node(node):
-            return node
-        return self.get_important_node(node.parent)
+        # Splits can only turn a large node small, never the reverse, so a cached
+        # important node that is still large is still the answer. Otherwise keep
+        # climbing, jumping through the ancestors' cached important nodes.
+        important_node = node.important_node if node.important_node is not None else node
+        while not self.is_large_node(important_node):
+            parent = important_node.parent
+            important_node = parent.important_node if parent.important_node is not None else parent
+        node.important_node = important_node
+        return important_node
 
     def evict_callback(self, node: TreeNode, runtime_selected: int):
         """Method to handle eviction logic."""
@@ -291,13 +407,13 @@ class GlobalSchedulerWithTime:
     def calculate_min_load_cost(self, leaf_node, selected_gpus):
         # histogram_mem_cost = self.histogram.current_allocation_cost_per_gpu
         histogram_mem_cost = self.histogram.current_allocation_per_gpu()
-        costs = []
+        gpu_selected, min_cost = None, None
         for gpu_id in selected_gpus:
             cost = histogram_mem_cost[gpu_id]
             if self.enable_eviction:
                 cost += self.virtual_evict_for_routing(leaf_node, gpu_id)
-            costs.append(cost)
-        gpu_selected = int(np.argmin(costs))
+            if min_cost is None or cost < min_cost:
+                gpu_selected, min_cost = gpu_id, cost
         return gpu_selected
 
 
@@ -313,9 +429,12 @@ class GlobalSchedulerWithTime:
         decoding_length = sampling_params.get("max_new_tokens", sampling_params.get("max_tokens", 45))
         # Tokenize the text
         start_time = time.time()
+        # Everything below the lock touches the shared tree, histogram or
+        # allocations, so only request-local work is done before taking it
+        key = tuple(input_ids)
         with self.lock:
             split_nodes = {}
-            leaf_node = self.cache.insert(tuple(input_ids), split_nodes=split_nodes)
+            leaf_node = self.cache.insert(key, split_nodes=split_nodes)
             self.handle_split_nodes_gpu_allocations(split_nodes, self.gpu_allocations) # copies split node gpu allocation
             self.handle_split_node_histogram(split_nodes)
 
@@ -325,7 +444,7 @@ class GlobalSchedulerWithTime:
                 if len(gpu_selected) > 1:
                     runtime_idx = self.calculate_min_load_cost(leaf_node, gpu_selected)
                 else:
-                    runtime_idx = list(gpu_selected)[0]
+                    runtime_idx = next(iter(gpu_selected))
             elif runtime_id_with_highest_hit_rate is not None:
                 runtime_idx = runtime_id_with_highest_hit_rate
             else:
@@ -336,7 +455,8 @@ class GlobalSchedulerWithTime:
 
             assert self.is_large_node(important_node)
 
-            self.histogram.update(datetime.now(), important_node, leaf_node, runtime_idx, decoding_length=decoding_length)
+            self.histogram.update(time.monotonic(), important_node, leaf_node, runtime_idx, decoding_length=decoding_length)
+            self.histogram.refresh_path_allocation(leaf_node)
             self.per_gpu_load[runtime_idx] += 1
 
             # NOTE: eviction handled by iterative feedback
@@ -345,26 +465,29 @@ class GlobalSchedulerWithTime:
             if self.enable_rebalancing:
                 if leaf_node.depth - important_node.depth < self.REBALANCING_CHAIN_LENGTH: # Ignore longer chains for Infercept optimizations
                     self.handle_important_node_stealing(runtime_idx)
-        self.metrics_dict.append(
-            {
-                "text": text,
-                "rid": request_id,
-                "selected_runtime": runtime_idx,
-                "overhead": time.time() - start_time,
-            }
-        )
+        if self.enable_metrics:
+            self.metrics_dict.append(
+                {
+                    "text": text,
+                    "rid": request_id,
+                    "selected_runtime": runtime_idx,
+                    "overhead": time.time() - start_time,
+                }
+            )
         return runtime_idx
     
     def finish_request(
         self, text: str = None, request_id: str = None, input_ids=None, func_output: RequestFuncOutput=None
     ):
+        runtime_id = func_output.runtime_selected
         with self.lock:
-            runtime_id = func_output.runtime_selected
-            self.update_overload_detector(input_ids, runtime_id, func_output)
-            important_node = self.get_important_node(self.cache.find_node(input_ids))
+            leaf_node = self.cache.find_node(input_ids)
+            important_node = self.get_important_node(leaf_node)
+            self.update_overload_detector(important_node, runtime_id, func_output)
             # if func_output.output_len != 1:
             #     important_node.decode_length.append(func_output.output_len)
             self.cache.remove_completed_input_ids(input_ids, runtime_id)
+            self.histogram.refresh_path_allocation(leaf_node)
             if func_output.tpot != 0 and func_output.output_len != 1:
                 self.avg_topt_per_gpu[runtime_id].append(func_output.tpot)
 
@@ -379,96 +502,109 @@ class GlobalSchedulerWithTime:
             return
         # allocation_cost_per_gpu = self.histogram.current_allocation_per_gpu_with_atleast_min_load(2)
         allocation_cost_per_gpu = self.histogram.current_allocation_per_gpu_with_atleast_min_load(2)
-        allocations_with_indices = [(gpu_id, allocation_cost_per_gpu[gpu_id]) for gpu_id in range(len(allocation_cost_per_gpu))]
+        costs = np.asarray(allocation_cost_per_gpu, dtype=np.float64)
+        # Most loaded gpu first, ties keep gpu order
+        order = np.argsort(-costs, kind='stable')
+        allocations_with_indices = [(int(gpu_id), float(costs[gpu_id])) for gpu_id in order]
         # logger.info(allocations_with_indices)
-        allocations_with_indices = list(sorted(allocations_with_indices, key=lambda x: -x[1]))
         self.handle_important_node_stealing_recursive(allocations_with_indices)
 
     def handle_important_node_stealing_recursive(self, allocation_cost_with_devices):
-        if len(allocation_cost_with_devices) == 1:
-            return
-        larger_device, larger_allocation_cost = allocation_cost_with_devices[0]
-        smaller_device, smaller_device_allocation_cost = allocation_cost_with_devices[-1] # Last element is the smallest
-
-        if larger_allocation_cost < self.HIGH_LOAD_THRESHOLD * smaller_device_allocation_cost:
-            return
-        # if datetime.now() - self.last_rebalancing_time < self.min_rebalancing_interval:
-        #     return
-        # self.last_rebalancing_time = datetime.now()
-
-
-        # if self.per_gpu_load[larger_device] < self.HIGH_LOAD_THRESHOLD * self.per_gpu_load[smaller_device]:
-        #     return
-        # Use a min heap to manage node costs
-        tpot = np.median(self.avg_topt_per_gpu[larger_device])
-        node_cost_for_gpu = []
-        all_rebalancing_cost = []
-        for node, cost in self.histogram.histogram.items():
-            if larger_device in self.gpu_allocations.get(node) and self.is_large_node(node) and self.histogram.node_to_count[node] > 1:
-                rebalancing_cost = self.histogram.get_node_cost(node, larger_device, tpot)
-                heapq.heappush(node_cost_for_gpu, (rebalancing_cost, node))
-                all_rebalancing_cost.append(rebalancing_cost)
+        # Pair the most loaded remaining gpu with the least loaded one, then drop it
+        while len(allocation_cost_with_devices) > 1:
+            larger_device, larger_allocation_cost = allocation_cost_with_devices[0]
+            smaller_device, smaller_device_allocation_cost = allocation_cost_with_devices[-1] # Last element is the smallest
+
+            if larger_allocation_cost < self.HIGH_LOAD_THRESHOLD * smaller_device_allocation_cost:
+                return
+            # if time.monotonic() - self.last_rebalancing_time < self.min_rebalancing_interval:
+            #     return
+            # self.last_rebalancing_time = time.monotonic()
+
+
+            # if self.per_gpu_load[larger_device] < self.HIGH_LOAD_THRESHOLD * self.per_gpu_load[smaller_device]:
+            #     return
+            # Use a min heap to manage node costs
+            tpot = np.median(self.avg_topt_per_gpu[larger_device])
+            node_cost_for_gpu = []
+            all_rebalancing_cost = []
+            for node, cost in self.histogram.histogram.items():
+                if larger_device in self.gpu_allocations.get(node) and self.is_large_node(node) and self.histogram.node_to_count[node] > 1:
+                    rebalancing_cost = self.histogram.get_node_cost(node, larger_device, tpot)
+                    node_cost_for_gpu.append((rebalancing_cost, node))
+                    all_rebalancing_cost.append(rebalancing_cost)
+            # Most passes only pop a few of the cheapest nodes, heapify is O(n)
+            heapq.heapify(node_cost_for_gpu)
         
-        # pop from top of priority queue if it's smaller than 5 percentile of rest of the nodes
-        # if all_rebalancing_cost:
-        #     min_rebalancing_cost = np.percentile(all_rebalancing_cost, 5) # don't rebalance nodes that don't have very little cost
-        #     breakpoint()
-        #     while node_cost_for_gpu and node_cost_for_gpu[0][0] < min_rebalancing_cost:
-        #         heapq.heappop(node_cost_for_gpu)
-
-        if len(node_cost_for_gpu) == 1:
-            # Handle load splitting a single node in two
-            cost, node = node_cost_for_gpu[0] 
-            cost /= 2 # load is now split into two
-            # if not node.has_cached_gpu(smaller_device) and self.overload_detector.is_node_overloaded(node, larger_device): 
-            if smaller_device not in self.gpu_allocations[node] and self.overload_detector.is_node_overloaded(node, larger_device): 
-                # Copying the node to the smallest device will not change the larger allocation
-                larger_allocation_cost -= cost
-                smaller_device_allocation_cost += cost
-                self.gpu_allocations[node].add(smaller_device)
-                self.overload_detector.delete_after_allocation(node, larger_device)
-        else:
-            steal_n = 0
-            while node_cost_for_gpu:
-                node: TreeNode
-                cost, node = heapq.heappop(node_cost_for_gpu)
-
-                assert self.is_large_node(node)
-                # if node.has_cached_gpu(smaller_device): # Avoid copying an existing device
-                # if smaller_device in self.gpu_allocations[node]:
-                #     continue
-
-                if larger_allocation_cost - cost < smaller_device_allocation_cost + cost:
-                    break
-                larger_allocation_cost -= cost
-                smaller_device_allocation_cost += cost
-                self.gpu_allocations[node] = {smaller_device}
-
-                self.histogram.migrate_node_cost(node, larger_device, smaller_device)
-                self.update_children(node, smaller_device)
-                steal_n += 1
-                if larger_allocation_cost < self.HIGH_LOAD_THRESHOLD * smaller_device_allocation_cost:
-                    break
-            # Upstead the sorted allocation based on the new smallest allocation
-            if steal_n != 0:
-                logger.info(f"Steal {steal_n} nodes from {larger_device} to {smaller_device}")
-        allocation_cost_with_devices[0] = (larger_device, larger_allocation_cost)
-        allocation_cost_with_devices[-1] = (smaller_device, smaller_device_allocation_cost)
-        self.handle_important_node_stealing_recursive(allocation_cost_with_devices[1:])
+            # pop from top of priority queue if it's smaller than 5 percentile of rest of the nodes
+            # if all_rebalancing_cost:
+            #     min_rebalancing_cost = np.percentile(all_rebalancing_cost, 5) # don't rebalance nodes that don't have very little cost
+            #     breakpoint()
+            #     while node_cost_for_gpu and node_cost_for_gpu[0][0] < min_rebalancing_cost:
+            #         heapq.heappop(node_cost_for_gpu)
+
+            if len(node_cost_for_gpu) == 1:
+                # Handle load splitting a single node in two
+                cost, node = node_cost_for_gpu[0] 
+                cost /= 2 # load is now split into two
+                # if not node.has_cached_gpu(smaller_device) and self.overload_detector.is_node_overloaded(node, larger_device): 
+                if smaller_device not in self.gpu_allocations[node] and self.overload_detector.is_node_overloaded(node, larger_device): 
+                    # Copying the node to the smallest device will not change the larger allocation
+                    larger_allocation_cost -= cost
+                    smaller_device_allocation_cost += cost
+                    self.gpu_allocations[node].add(smaller_device)
+                    self.histogram.refresh_node_allocation(node)
+                    self.overload_detector.delete_after_allocation(node, larger_device)
+            else:
+                steal_n = 0
+                while node_cost_for_gpu:
+                    node: TreeNode
+                    cost, node = heapq.heappop(node_cost_for_gpu)
+
+                    assert self.is_large_node(node)
+                    # if node.has_cached_gpu(smaller_device): # Avoid copying an existing device
+                    # if smaller_device in self.gpu_allocations[node]:
+                    #     continue
+
+                    if larger_allocation_cost - cost < smaller_device_allocation_cost + cost:
+                        break
+                    larger_allocation_cost -= cost
+                    smaller_device_allocation_cost += cost
+                    self.gpu_allocations[node] = {smaller_device}
+                    self.histogram.refresh_node_allocation(node)
+
+                    self.histogram.migrate_node_cost(node, larger_device, smaller_device)
+                    self.update_children(node, smaller_device)
+                    steal_n += 1
+                    if larger_allocation_cost < self.HIGH_LOAD_THRESHOLD * smaller_device_allocation_cost:
+                        break
+                # Upstead the sorted allocation based on the new smallest allocation
+                if steal_n != 0:
+                    logger.info(f"Steal {steal_n} nodes from {larger_device} to {smaller_device}")
+            allocation_cost_with_devices[0] = (larger_device, larger_allocation_cost)
+            allocation_cost_with_devices[-1] = (smaller_device, smaller_device_allocation_cost)
+            allocation_cost_with_devices = allocation_cost_with_devices[1:]
 
     def update_children(self, node: TreeNode, gpu_id):
-        for child in node.children.values():
+        stack = list(node.children.values())
+        while stack:
+            child = stack.pop()
             self.gpu_allocations[child] = {gpu_id}
-            self.update_children(child, gpu_id)
+            self.histogram.refresh_node_allocation(child)
+            stack.extend(child.children.values())
     
     def print(self):
         self._print_helper(self.cache.root_node, 0)
 
-    def _print_helper(self, node: TreeNode, indent=0, depth=0):
-        for key, child in node.children.items():
+    def _print_helper(self, node: TreeNode, indent=0):
+        tokenizer = _get_tokenizer()
+        # Children are pushed in reverse so they print in insertion order
+        stack = [(child, indent) for child in reversed(list(node.children.values()))]
+        while stack:
+            child, indent = stack.pop()
             allocated_gpus = self.gpu_allocations.get(child, set())
             print(f"{' ' * indent}{tokenizer.decode(child.value)[:20].strip()} Cached: {child.cached_gpus} Allocated: {allocated_gpus} Evicted: {child.evicted_gpus} {len(child.value)} Decode Lengths {list(child.decode_length)[:5]}")
-            self._print_helper(child, indent=indent + 2, depth=depth + 1)
+            stack.extend((grandchild, indent + 2) for grandchild in reversed(list(child.children.values())))
 
     def work_steal_low_loaded_prefixes(self):
         low_load_nodes = []
@@ -485,14 +621,12 @@ class GlobalSchedulerWithTime:
         y = len(low_load_nodes)
         x = self.num_gpus - y
         for runtime_id in low_load_nodes:
-            if np.random.rand() < y/(x + y): # Steal the node
+            if random.random() < y/(x + y): # Steal the node
 
                 return runtime_id
         return None
 
-    def update_overload_detector(self, input_ids, runtime_idx, func_output: RequestFuncOutput):
+    def update_overload_detector(self, important_node: TreeNode, runtime_idx, func_output: RequestFuncOutput):
         # Overload detector based on the current ttft
-        leaf_node = self.cache.find_node(input_ids)
-        important_node = self.get_important_node(leaf_node)
-        self.overload_detector.add_data_point(datetime.now(), important_node, runtime_idx, func_output.ttft)
+        self.overload_detector.add_data_point(time.monotonic(), important_node, runtime_idx, func_output.ttft)
     
\ No newline at end of file
@@ -1,28 +1,41 @@
 from collections import defaultdict
-from datetime import datetime, timedelta
 from global_lru_cache import LPRadixCache, LPTreeNode
 import time
+import random
 import numpy as np
 import threading
 import heapq
 from collections import deque
 from typing import List, Tuple
-from transformers import AutoTokenizer
 import logging
 from benchmarks.exp_configs.model_equations_numpy import LP_mistral_7b_A6000_sglang_extend_flashinfer as prefill_time
-
-tokenizer = AutoTokenizer.from_pretrained("mistralai/Mistral-7B-v0.1")
+from ttft_overload_detector import TTFTWindowedOverloadedDetector
 
 logger = logging.getLogger(__name__)
 
+_EMPTY_SET = frozenset()
+
 class SlidingWindowHistogram:
+    __slots__ = (
+        'window_duration', 'gpu_allocations', 'histogram', 'node_to_count', 'timestamps',
+        '_node_alias', '_id_of', '_next_node_id', 'num_gpus', 'enable_miss_rate',
+        'prev_mis_rates', 'hit_tokens', 'prompt_tokens', 'decoding_size',
+        'avg_topt_per_gpu', 'current_allocation_cost_per_gpu',
+        'per_node_per_gpu_allocation_cost',
+    )
+
     def __init__(self, window_duration, gpu_allocations, num_gpus=2, enable_miss_rate=True,avg_topt_per_gpu=None):
         self.window_duration = window_duration
         self.gpu_allocations = gpu_allocations
         self.histogram = defaultdict(int)
         self.node_to_count = defaultdict(int)
 
-        self.timestamps = []
+        self.timestamps = deque()
+        # Timestamps reference important nodes by a stable id so a split only
+        # needs to repoint the id instead of rewriting the whole window
+        self._node_alias = {}
+        self._id_of = {}
+        self._next_node_id = 0
         self.num_gpus = num_gpus
         self.enable_miss_rate = enable_miss_rate
         self.prev_mis_rates = {}
@@ -35,7 +48,7 @@ class SlidingWindowHistogram:
         self.per_node_per_gpu_allocation_cost = defaultdict(lambda: defaultdict(int))
 
     def update(self, timestamp, node, leaf_node, runtime_idx, decoding_length):
-        self.timestamps.append((timestamp, node, leaf_node))
+        self.timestamps.append((timestamp, self._get_node_id(node), leaf_node))
         self.histogram[node] += 1 * leaf_node.context_length
         self.node_to_count[node] += 1
         self.decoding_size[node] = decoding_length
@@ -60,10 +73,23 @@ class SlidingWindowHistogram:
         old_cost = self.per_node_per_gpu_allocation_cost[node][runtime_idx]
         self.current_allocation_cost_per_gpu[runtime_idx] -= old_cost
     
+    def _get_node_id(self, node):
+        node_id = self._id_of.get(node)
+        if node_id is None:
+            node_id = self._next_node_id
+            self._next_node_id += 1
+            self._id_of[node] = node_id
+            self._node_alias[node_id] = node
+        return node_id
+
     def _remove_old_entries(self, current_timestamp):
+        timestamps = self.timestamps
         window_start = current_timestamp - self.window_duration
-        while self.timestamps and self.timestamps[0][0] < window_start:
-            timestamp, node, leaf_node = self.timestamps.pop(0)
+        if not timestamps or timestamps[0][0] >= window_start:
+            return # common case, nothing has expired yet
+        while timestamps and timestamps[0][0] < window_start:
+            timestamp, node_id, leaf_node = timestamps.popleft()
+            node = self._node_alias[node_id]
             self.histogram[node] -= 1 * leaf_node.context_length
             self.node_to_count[node] -= 1
             self.hit_tokens[node] -= leaf_node.context_length - leaf_node.num_tokens
@@ -75,6 +101,7 @@ class SlidingWindowHistogram:
                 del self.hit_tokens[node]
                 del self.prompt_tokens[node]
                 del self.decoding_size[node]
+                del self._node_alias[self._id_of.pop(node)]
                 self.gpu_allocations[node] = set() # Reset the gpu allocation outside the time window
 
     def rename_node(self, old_node, new_node):
@@ -88,12 +115,9 @@ class SlidingWindowHistogram:
             self.hit_tokens[new_node] = self.hit_tokens.pop(old_node)
             self.prompt_tokens[new_node] = self.prompt_tokens.pop(old_node)
             self.decoding_size[new_node] = self.decoding_size.pop(old_node)
-            timestamps = []
-            for timestamp, important_node, leaf_node in self.timestamps:
-                if important_node == old_node:
-                    important_node = new_node
-                timestamps.append((timestamp, important_node, leaf_node))
-            self.timestamps = timestamps
+            node_id = self._id_of.pop(old_node)
+            self._node_alias[node_id] = new_node
+            self._id_of[new_node] = node_id
 
     def query(self):
         return dict(self.histogram)
@@ -104,9 +128,15 @@ class SlidingWindowHistogram:
         for gpu in range(self.num_gpus):
             topt = np.median(self.avg_topt_per_gpu[gpu])
             topts.append(topt)
-        for node, cost in self.histogram.items():
-            for gpu in self.gpu_allocations.get(node, {}):
-                allocation[gpu] += self.get_node_cost(node, gpu, topts[gpu])
+        for node in self.histogram:
+            gpus = self.gpu_allocations.get(node)
+            if not gpus:
+                continue
+            # prefill share and output length do not depend on the gpu
+            prefill_cost = self.get_prefill_cost(node)
+            output_len = self.get_output_len(node)
+            for gpu in gpus:
+                allocation[gpu] += prefill_cost + node.ref_counter[gpu] * output_len * topts[gpu]
         return allocation
 
     def current_allocation_per_gpu_with_atleast_min_load(self, min_load=2):
@@ -115,18 +145,29 @@ class SlidingWindowHistogram:
         for gpu in range(self.num_gpus):
             topt = np.median(self.avg_topt_per_gpu[gpu])
             topts.append(topt)
-        for node, cost in self.histogram.items():
-            for gpu in self.gpu_allocations.get(node, {}):
-                if self.node_to_count[node] < min_load:
-                    continue
-                allocation[gpu] += self.get_node_cost(node, gpu, topts[gpu])
+        for node in self.histogram:
+            if self.node_to_count[node] < min_load:
+                continue
+            gpus = self.gpu_allocations.get(node)
+            if not gpus:
+                continue
+            prefill_cost = self.get_prefill_cost(node)
+            output_len = self.get_output_len(node)
+            for gpu in gpus:
+                allocation[gpu] += prefill_cost + node.ref_counter[gpu] * output_len * topts[gpu]
         return allocation
 
-    def get_node_cost(self, node, gpu, topt):
-        prefill_cost = self.prev_mis_rates[node] * self.node_to_count[node] * prefill_time(node.num_tokens, node.context_length) / len(self.gpu_allocations.get(node)) # potentionally divide by length of node.cached_gpus here
-        output_len = self.decoding_size[node]
+    def get_prefill_cost(self, node):
+        return self.prev_mis_rates[node] * self.node_to_count[node] * prefill_time(node.num_tokens, node.context_length) / len(self.gpu_allocations.get(node)) # potentionally divide by length of node.cached_gpus here
+
+    def get_output_len(self, node):
         if node.decode_length:
-            output_len = np.mean(node.decode_length)
+            return np.mean(node.decode_length)
+        return self.decoding_size[node]
+
+    def get_node_cost(self, node, gpu, topt):
+        prefill_cost = self.get_prefill_cost(node)
+        output_len = self.get_output_len(node)
         active_requests = node.ref_counter[gpu]
         decode_cost = active_requests * output_len * topt
         return prefill_cost + decode_cost
@@ -141,74 +182,20 @@ class SlidingWindowHistogram:
             eviction_cost = 0
         return eviction_cost
                                                                                 
-class TTFTWindowedOverloadedDetector:
-    # TTFT is a good indicator of overloaded
-
-    def __init__(self, window_duration=timedelta(minutes=3)):
-        self.data = {}
-        self.window_duration = window_duration
-        self.half_window_duration = window_duration / 2
-
-    def add_data_point(self, timestamp, node, gpu, value):
-        """ Add a new data point and remove outdated entries. """
-        key = (node, gpu)
-        if key not in self.data:
-            self.data[key] = deque()
-        self.data[key].append((timestamp, value))
-        self.purge_old_data(key, timestamp)
-
-    def purge_old_data(self, key, current_time):
-        """ Remove data points that are older than the time window. """
-        while self.data[key] and self.data[key][0][0] < current_time - self.window_duration:
-            self.data[key].popleft()
-
-    def rename_node(self, old_node, new_node, runtime_idx):
-        old_key = (old_node, runtime_idx)
-        new_key = (new_node, runtime_idx)
-        if old_key in self.data:
-            self.data[new_key] = self.data.pop(old_key)
-
-    def calculate_half_window_averages(self, key):
-        """ Calculate averages for the first and second halves of the window. """
-        first_half = []
-        second_half = []
-        half_window_cutoff = datetime.now() - self.half_window_duration
-        if key not in self.data:
-            return None, None
-        for timestamp, value in self.data[key]:
-            if timestamp < half_window_cutoff:
-                first_half.append(value)
-            else:
-                second_half.append(value)
-        if len(first_half) == 0:
-            return None, None
-        if len(second_half) == 0:
-            return  None, None
-        avg_first_half = sum(first_half) / len(first_half) if first_half else 0
-        avg_second_half = sum(second_half) / len(second_half) if second_half else 0
-
-        return avg_first_half, avg_second_half
-    
-    def delete_after_allocation(self, node, gpu):
-        key = (node, gpu)
-        if key in self.data:
-            del self.data[key]
-
-    def is_node_overloaded(self, node, gpu):
-        """ Check if node is overloaded """
-        key = (node, gpu)
-        avg_first_half, avg_second_half = self.calculate_half_window_averages(key)
-        if avg_first_half is None and avg_second_half is None:
-            return False
-        return avg_second_half >= 2 * avg_first_half
-
-
 class GlobalSchedulerWithTimePerf:
+    __slots__ = (
+        'num_gpus', 'gpu_allocations', 'counter', 'enable_eviction', 'per_gpu_load',
+        'all_gpus', 'mem_cost', 'enable_metrics', 'metrics_dict', 'lock', 'enable_miss_rate',
+        'avg_topt_per_gpu', 'histogram', 'cache', 'max_tokens_gpu',
+        'HIGH_LOAD_THRESHOLD', 'overload_detector', 'enable_rebalancing',
+    )
+
     def __init__(self, 
                  num_nodes=2, 
                  enable_eviction=False, 
                  enable_rebalancing=True, 
-                 enable_miss_rate=True
+                 enable_miss_rate=True,
+                 enable_metrics=False,
         ):
         self.num_gpus = num_nodes
         self.gpu_allocations = {}
@@ -219,7 +206,9 @@ class GlobalSchedulerWithTimePerf:
 
         self.mem_cost = [0 for _ in range(num_nodes)]
         self.num_gpus = num_nodes
-        self.metrics_dict = []
+        # Bounded so long runs do not keep every request's text alive
+        self.enable_metrics = enable_metrics
+        self.metrics_dict = deque(maxlen=10000)
         self.lock = threading.Lock()
         self.enable_miss_rate = enable_miss_rate
         self.avg_topt_per_gpu = [deque(maxlen=200) for _ in range(num_nodes)] 
@@ -227,7 +216,7 @@ class GlobalSchedulerWithTimePerf:
             self.avg_topt_per_gpu[i].append(.15)
 
         self.histogram = SlidingWindowHistogram(
-            window_duration=timedelta(minutes=3), 
+            window_duration=3 * 60, 
             gpu_allocations=self.gpu_allocations, 
             num_gpus=self.num_gpus, 
             enable_miss_rate=self.enable_miss_rate,
@@ -236,7 +225,7 @@ class GlobalSchedulerWithTimePerf:
         self.cache = LPRadixCache(histogram=self.histogram, num_gpus=self.num_gpus, lock=self.lock)
         self.max_tokens_gpu = [198516 for _ in range(num_nodes)]
         self.HIGH_LOAD_THRESHOLD = 1.5
-        self.overload_detector = TTFTWindowedOverloadedDetector(window_duration=timedelta(minutes=3))
+        self.overload_detector = TTFTWindowedOverloadedDetector(window_duration=3 * 60)
         self.enable_rebalancing = enable_rebalancing
 
 
@@ -251,28 +240,30 @@ class GlobalSchedulerWithTimePerf:
         for child, parent_node in split_nodes.items():
             if self.is_large_node(parent_node) and not self.is_large_node(child): # new node is parent is now larger
                 self.histogram.rename_node(child, parent_node)
-                for gpu in self.gpu_allocations.get(child, {}):
+                for gpu in self.gpu_allocations.get(child, _EMPTY_SET):
                     self.overload_detector.rename_node(child, parent_node, gpu)
 
-    # Recursively update get/update parent gpu allocation
+    # Nearest ancestor-or-self with a gpu allocation, all gpus if there is none
     def get_parent_gpu_allocation(self, node):
-        if not node:
-            return self.all_gpus
-        if self.gpu_allocations.get(node):
-            return self.gpu_allocations.get(node)
-        return self.get_parent_gpu_allocation(node.parent)
-
-    def update_gpu_cache_for_parent(self,node, gpu_id):
-        if not node:
-            return
-        node.cached_gpus = node.cached_gpus.union(gpu_id)
-        self.update_cached_gpus_of_parent(node.parent, gpu_id)
+        while node:
+            gpus = self.gpu_allocations.get(node)
+            if gpus:
+                return gpus
+            node = node.parent
+        return self.all_gpus
+
+    def update_gpu_cache_for_parent(self, node, gpu_id):
+        while node:
+            node.cached_gpus.update(gpu_id)
+            node = node.parent
 
     def update_gpu_allocation_for_parent(self, node, gpu_id):
-        if not node:
-            return
-        self.gpu_allocations[node] = self.gpu_allocations.get(node, set()).union(gpu_id)
-        self.update_gpu_allocation_for_parent(node.parent, gpu_id)
+        while node:
+            gpus = self.gpu_allocations.get(node)
+            if gpus is None:
+                gpus = self.gpu_allocations[node] = set()
+            gpus.update(gpu_id)
+            node = node.parent
 
     def is_small_node(self, node):
         return not self.is_large_node(node)
@@ -281,34 +272,37 @@ class GlobalSchedulerWithTimePerf:
         return node.num_tokens > node.context_length - node.num_tokens
 
     def get_important_node(self, node):
-        if self.is_large_node(node):
-            return node
-        return self.get_important_node(node.parent)
+        # Splits can only turn a large node small, never the reverse, so a cached
+        # important node that is still large is still the answer. Otherwise keep
+        # climbing, jumping through the ancestors' cached important nodes.
+        important_node = node.important_node if node.important_node is not None else node
+        while not self.is_large_node(important_node):
+            parent = important_node.parent
+            important_node = parent.important_node if parent.important_node is not None else parent
+        node.important_node = important_node
+        return important_node
 
     def get_recomp_cost(self, node, gpu_id, histogram):
-        if not node:
-            return 0
-        if node.has_cached_gpu(gpu_id):
-            return 0
-        else:
-            return histogram.histogram.get(node, 1) + self.get_recomp_cost(node.parent, gpu_id, histogram)
+        cost = 0
+        while node and not node.has_cached_gpu(gpu_id):
+            cost += histogram.histogram.get(node, 1)
+            node = node.parent
+        return cost
 
     def get_recomp_cost_basic(self, node, gpu_id):
-        if not node:
-            return 0
-        if node.has_cached_gpu(gpu_id):
-            return 0
-        else:
+        cost = 0
+        while node and not node.has_cached_gpu(gpu_id):
             ref_cnt_cached = sum([node.ref_counter[gpu] for gpu in node.cached_gpus])
-            return node.num_tokens * ref_cnt_cached + self.get_recomp_cost_basic(node.parent, gpu_id)
+            cost += node.num_tokens * ref_cnt_cached
+            node = node.parent
+        return cost
 
     def get_recomp_cost_basic_time(self, node, gpu_id):
-        if not node:
-            return 0
-        if node.has_cached_gpu(gpu_id):
-            return 0
-        else:
-            return prefill_time(node.num_tokens, node.context_length) + self.get_recomp_cost_basic_time(node.parent, gpu_id)
+        cost = 0
+        while node and not node.has_cached_gpu(gpu_id):
+            cost += prefill_time(node.num_tokens, node.context_length)
+            node = node.parent
+        return cost
 
     def evict_callback(self, node, runtime_selected):
         """Method to handle eviction logic."""
@@ -335,6 +329,17 @@ class GlobalSchedulerWithTimePerf:
             eviction_cost += self.histogram.get_eviction_prefill_cost(victim, runtime_selected, self.is_large_node(victim))
         return eviction_cost
     
+    def calculate_min_load_cost(self, leaf_node, selected_gpus, histogram_mem_cost):
+        # recomputation cost is not modeled yet and always 0
+        gpu_selected, min_cost = None, None
+        for gpu_id in selected_gpus:
+            cost = histogram_mem_cost[gpu_id]
+            if self.enable_eviction:
+                cost += self.virtual_evict_for_routing(leaf_node, gpu_id)
+            if min_cost is None or cost < min_cost:
+                gpu_selected, min_cost = gpu_id, cost
+        return gpu_selected
+
     def runtime_selector(
         self,
         text = None,
@@ -361,56 +366,21 @@ class GlobalSchedulerWithTimePerf:
             gpu_selected = self.get_parent_gpu_allocation(leaf_node)
         else:
             if runtime_id_with_highest_hit_rate is None:
-                recom_costs = []
-                for gpu_id in range(self.num_gpus):
-                    recomputation_cost = 0
-                    recom_costs.append(recomputation_cost)
-
                 histogram_mem_cost = self.histogram.current_allocation_cost_per_gpu
-                if self.enable_eviction:
-                    costs = [
-                        recom_costs[gpu_id] + \
-                        histogram_mem_cost[gpu_id] + \
-                        self.virtual_evict_for_routing(leaf_node, gpu_id)
-                        for gpu_id in range(self.num_gpus)
-                    ]
-                else:
-                    costs = [
-                        recom_costs[gpu_id] + \
-                        histogram_mem_cost[gpu_id]
-                        for gpu_id in range(self.num_gpus)
-                    ]
-                gpu_selected = int(np.argmin(costs))
+                gpu_selected = self.calculate_min_load_cost(leaf_node, range(self.num_gpus), histogram_mem_cost)
                 gpu_selected = set([gpu_selected])
             else:
                 gpu_selected = set([runtime_id_with_highest_hit_rate])
 
-        runtime_idx = list(gpu_selected)[0]
+        runtime_idx = next(iter(gpu_selected))
         if len(gpu_selected) > 1:
             # find the index that's lower
-            recom_costs = []
-            for gpu_id in range(self.num_gpus):
-                recomputation_cost = 0
-                recom_costs.append(recomputation_cost)
             histogram_mem_cost = self.histogram.current_allocation_per_gpu()
-            if self.enable_eviction:
-                costs = [
-                    recom_costs[gpu_id] + \
-                    histogram_mem_cost[gpu_id] + \
-                    self.virtual_evict_for_routing(leaf_node, gpu_id)
-                    for gpu_id in gpu_selected
-                ]
-            else:
-                costs = [
-                    recom_costs[gpu_id] + \
-                    histogram_mem_cost[gpu_id]
-                    for gpu_id in gpu_selected
-                ]
-            runtime_idx = int(np.argmin(costs))
-            # runtime_idx = int(np.random.choice(list(gpu_selected)))
+            runtime_idx = self.calculate_min_load_cost(leaf_node, gpu_selected, histogram_mem_cost)
+            # runtime_idx = random.choice(tuple(gpu_selected))
         self.counter += 1
         self.update_gpu_allocation_for_parent(leaf_node, gpu_selected)
-        self.histogram.update(datetime.now(), important_node, leaf_node, runtime_idx, decoding_length=decoding_length)
+        self.histogram.update(time.monotonic(), important_node, leaf_node, runtime_idx, decoding_length=decoding_length)
         
         self.per_gpu_load[runtime_idx] += 1
         self.cache.update_allocated_size(leaf_node, runtime_idx)
@@ -423,14 +393,15 @@ class GlobalSchedulerWithTimePerf:
 
             # self.work_steal_low_loaded_prefixes()
 
-        self.metrics_dict.append(
-            {
-                "text": text,
-                "rid": request_id,
-                "selected_runtime": runtime_idx,
-                "overhead": time.time() - start_time,
-            }
-        )
+        if self.enable_metrics:
+            self.metrics_dict.append(
+                {
+                    "text": text,
+                    "rid": request_id,
+                    "selected_runtime": runtime_idx,
+                    "overhead": time.time() - start_time,
+                }
+            )
         return runtime_idx
     
     def finish_request(
@@ -452,81 +423,87 @@ class GlobalSchedulerWithTimePerf:
         if sum(self.per_gpu_load.values()) < 50:
             return
         allocation_cost_per_gpu = self.histogram.current_allocation_per_gpu_with_atleast_min_load(2)
-        allocations_with_indices = [(gpu_id, allocation_cost_per_gpu[gpu_id]) for gpu_id in range(len(allocation_cost_per_gpu))]
+        costs = np.asarray(allocation_cost_per_gpu, dtype=np.float64)
+        # Most loaded gpu first, ties keep gpu order
+        order = np.argsort(-costs, kind='stable')
+        allocations_with_indices = [(int(gpu_id), float(costs[gpu_id])) for gpu_id in order]
         # logger.info(allocations_with_indices)
-        allocations_with_indices = list(sorted(allocations_with_indices, key=lambda x: -x[1]))
         self.handle_important_node_stealing_recursive(allocations_with_indices)
 
     def handle_important_node_stealing_recursive(self, allocation_cost_with_devices):
-        if len(allocation_cost_with_devices) == 1:
-            return
-        larger_device, larger_allocation_cost = allocation_cost_with_devices[0]
-        smaller_device, smaller_device_allocation_cost = allocation_cost_with_devices[-1] # Last element is the smallest
-
-        if larger_allocation_cost < self.HIGH_LOAD_THRESHOLD * smaller_device_allocation_cost:
-            return
-        # if self.per_gpu_load[larger_device] < self.HIGH_LOAD_THRESHOLD * self.per_gpu_load[smaller_device]:
-        #     return
+        # Pair the most loaded remaining gpu with the least loaded one, then drop it
+        while len(allocation_cost_with_devices) > 1:
+            larger_device, larger_allocation_cost = allocation_cost_with_devices[0]
+            smaller_device, smaller_device_allocation_cost = allocation_cost_with_devices[-1] # Last element is the smallest
+
+            if larger_allocation_cost < self.HIGH_LOAD_THRESHOLD * smaller_device_allocation_cost:
+                return
+            # if self.per_gpu_load[larger_device] < self.HIGH_LOAD_THRESHOLD * self.per_gpu_load[smaller_device]:
+            #     return
         
-        # Use a min heap to manage node costs
-        node_cost_for_gpu = []
-        topts = []
-        for gpu in range(self.num_gpus):
-            topt = np.median(self.avg_topt_per_gpu[gpu])
-            topts.append(topt)
-
-        for node, cost in self.histogram.histogram.items():
-            # If after adjusting the nodes, the allocation difference is valid, allow adjustment
-            # if larger_device in self.gpu_allocations.get(node) and self.histogram.node_to_count[node] > 1:
-            #     heapq.heappush(node_cost_for_gpu, (cost, node))
-            if larger_device in self.gpu_allocations.get(node) and self.is_large_node(node) and self.histogram.node_to_count[node] > 1:
-                rebalancing_cost = self.histogram.get_node_cost(node, larger_device, topts[larger_device])
-                heapq.heappush(node_cost_for_gpu, (rebalancing_cost, node))
-
-        if len(node_cost_for_gpu) == 1:
-            # Handle load splitting a single node in two
-            cost, node = node_cost_for_gpu[0] 
-            cost /= 2 # load is now split into two
-            # if not node.has_cached_gpu(smaller_device) and self.overload_detector.is_node_overloaded(node, larger_device): 
-            if smaller_device not in self.gpu_allocations[node] and self.overload_detector.is_node_overloaded(node, larger_device): 
-                # Copying the node to the smallest device will not change the larger allocation
-                larger_allocation_cost -= cost
-                smaller_device_allocation_cost += cost
-                self.gpu_allocations[node].add(smaller_device)
-                self.overload_detector.delete_after_allocation(node, larger_device)
-        else:
-            steal_n = 0
-            while node_cost_for_gpu:
-                cost, node = heapq.heappop(node_cost_for_gpu)
-
-                assert self.is_large_node(node)
-                # if node.has_cached_gpu(smaller_device): # Avoid copying an existing device
-                # if smaller_device in self.gpu_allocations[node]:
-                #     continue
-
-                if larger_allocation_cost - cost < smaller_device_allocation_cost + cost:
-                    break
-                larger_allocation_cost -= cost
-                smaller_device_allocation_cost += cost
-                self.gpu_allocations[node] = {smaller_device}
-
-                self.remove_allocation_cost_for_node(node, larger_device)
-                self.update_allocation_cost_for_node(node, smaller_device)
-
-                self.update_children(node, smaller_device)
-                steal_n += 1
-                # if larger_allocation_cost < self.HIGH_LOAD_THRESHOLD * smaller_device_allocation_cost:
-                #     return
-            # Upstead the sorted allocation based on the new smallest allocation
-            logger.info(f"Steal {steal_n} nodes from {larger_device} to {smaller_device}")
-        allocation_cost_with_devices[0] = (larger_device, larger_allocation_cost)
-        allocation_cost_with_devices[-1] = (smaller_device, smaller_device_allocation_cost)
-        self.handle_important_node_stealing_recursive(allocation_cost_with_devices[1:])
+            # Use a min heap to manage node costs
+            node_cost_for_gpu = []
+            topts = []
+            for gpu in range(self.num_gpus):
+                topt = np.median(self.avg_topt_per_gpu[gpu])
+                topts.append(topt)
+
+            for node, cost in self.histogram.histogram.items():
+                # If after adjusting the nodes, the allocation difference is valid, allow adjustment
+                # if larger_device in self.gpu_allocations.get(node) and self.histogram.node_to_count[node] > 1:
+                #     heapq.heappush(node_cost_for_gpu, (cost, node))
+                if larger_device in self.gpu_allocations.get(node) and self.is_large_node(node) and self.histogram.node_to_count[node] > 1:
+                    rebalancing_cost = self.histogram.get_node_cost(node, larger_device, topts[larger_device])
+                    node_cost_for_gpu.append((rebalancing_cost, node))
+            # Most passes only pop a few of the cheapest nodes, heapify is O(n)
+            heapq.heapify(node_cost_for_gpu)
+
+            if len(node_cost_for_gpu) == 1:
+                # Handle load splitting a single node in two
+                cost, node = node_cost_for_gpu[0] 
+                cost /= 2 # load is now split into two
+                # if not node.has_cached_gpu(smaller_device) and self.overload_detector.is_node_overloaded(node, larger_device): 
+                if smaller_device not in self.gpu_allocations[node] and self.overload_detector.is_node_overloaded(node, larger_device): 
+                    # Copying the node to the smallest device will not change the larger allocation
+                    larger_allocation_cost -= cost
+                    smaller_device_allocation_cost += cost
+                    self.gpu_allocations[node].add(smaller_device)
+                    self.overload_detector.delete_after_allocation(node, larger_device)
+            else:
+                steal_n = 0
+                while node_cost_for_gpu:
+                    cost, node = heapq.heappop(node_cost_for_gpu)
+
+                    assert self.is_large_node(node)
+                    # if node.has_cached_gpu(smaller_device): # Avoid copying an existing device
+                    # if smaller_device in self.gpu_allocations[node]:
+                    #     continue
+
+                    if larger_allocation_cost - cost < smaller_device_allocation_cost + cost:
+                        break
+                    larger_allocation_cost -= cost
+                    smaller_device_allocation_cost += cost
+                    self.gpu_allocations[node] = {smaller_device}
+
+                    self.remove_allocation_cost_for_node(node, larger_device)
+                    self.update_allocation_cost_for_node(node, smaller_device)
+
+                    self.update_children(node, smaller_device)
+                    steal_n += 1
+                    # if larger_allocation_cost < self.HIGH_LOAD_THRESHOLD * smaller_device_allocation_cost:
+                    #     return
+                # Upstead the sorted allocation based on the new smallest allocation
+                logger.info(f"Steal {steal_n} nodes from {larger_device} to {smaller_device}")
+            allocation_cost_with_devices[0] = (larger_device, larger_allocation_cost)
+            allocation_cost_with_devices[-1] = (smaller_device, smaller_device_allocation_cost)
+            allocation_cost_with_devices = allocation_cost_with_devices[1:]
 
     def update_children(self, node, gpu_id):
-        for child in node.children.values():
+        stack = list(node.children.values())
+        while stack:
+            child = stack.pop()
             self.gpu_allocations[child] = {gpu_id}
-            self.update_children(child, gpu_id)
+            stack.extend(child.children.values())
     
     def work_steal_low_loaded_prefixes(self):
         low_load_nodes = []
@@ -543,7 +520,7 @@ class GlobalSchedulerWithTimePerf:
         y = len(low_load_nodes)
         x = self.num_gpus - y
         for runtime_id in low_load_nodes:
-            if np.random.rand() < y/(x + y): # Steal the node
+            if random.random() < y/(x + y): # Steal the node
 
                 return runtime_id
         return None
@@ -552,9 +529,11 @@ class GlobalSchedulerWithTimePerf:
         # Overload detector based on the current ttft
         leaf_node = self.cache.find_node(input_ids)
         important_node = self.get_important_node(leaf_node)
-        self.overload_detector.add_data_point(datetime.now(), important_node, runtime_idx, func_output.ttft)
+        self.overload_detector.add_data_point(time.monotonic(), important_node, runtime_idx, func_output.ttft)
 
 if __name__ == "__main__":
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained("mistralai/Mistral-7B-v0.1")
     perf = GlobalSchedulerWithTimePerf()
     from benchmarks.benchmark_workload_gen import ToolBenchDataLoader, LoadDistribution
 
@@ -1,10 +1,57 @@
 from collections import deque
-from datetime import datetime, timedelta
+import time
+
+class HalfWindowSeries:
+    """ Data points of one key, split into the older and newer half of the window.
+
+    Each half keeps a running sum so averages are O(1). Points only move from
+    the newer to the older half as time passes, which assumes timestamps are
+    added in non-decreasing order.
+    """
+
+    __slots__ = ('first_half', 'second_half', 'first_sum', 'second_sum')
+
+    def __init__(self):
+        self.first_half = deque()
+        self.second_half = deque()
+        self.first_sum = 0
+        self.second_sum = 0
+
+    def __len__(self):
+        return len(self.first_half) + len(self.second_half)
+
+    def append(self, timestamp, value):
+        self.second_half.append((timestamp, value))
+        self.second_sum += value
+
+    def oldest_timestamp(self):
+        half = self.first_half or self.second_half
+        return half[0][0]
+
+    def popleft(self):
+        if self.first_half:
+            timestamp, value = self.first_half.popleft()
+            self.first_sum = self.first_sum - value if self.first_half else 0
+        else:
+            timestamp, value = self.second_half.popleft()
+            self.second_sum = self.second_sum - value if self.second_half else 0
+        return timestamp, value
+
+    def advance(self, half_window_cutoff):
+        """ Move points older than the cutoff into the first half. """
+        while self.second_half and self.second_half[0][0] < half_window_cutoff:
+            timestamp, value = self.second_half.popleft()
+            self.first_half.append((timestamp, value))
+            self.first_sum += value
+            self.second_sum = self.second_sum - value if self.second_half else 0
+
 
 class TTFTWindowedOverloadedDetector:
     # TTFT is a good indicator of overloaded
 
-    def __init__(self, window_duration=timedelta(minutes=3)):
+    __slots__ = ('data', 'window_duration', 'half_window_duration')
+
+    def __init__(self, window_duration=3 * 60):
         self.data = {}
         self.window_duration = window_duration
         self.half_window_duration = window_duration / 2
@@ -13,14 +60,16 @@ class TTFTWindowedOverloadedDetector:
         """ Add a new data point and remove outdated entries. """
         key = (node, gpu)
         if key not in self.data:
-            self.data[key] = deque()
-        self.data[key].append((timestamp, value))
+            self.data[key] = HalfWindowSeries()
+        self.data[key].append(timestamp, value)
         self.purge_old_data(key, timestamp)
 
     def purge_old_data(self, key, current_time):
         """ Remove data points that are older than the time window. """
-        while self.data[key] and self.data[key][0][0] < current_time - self.window_duration:
-            self.data[key].popleft()
+        series = self.data[key]
+        window_start = current_time - self.window_duration
+        while series and series.oldest_timestamp() < window_start:
+            series.popleft()
 
     def rename_node(self, old_node, new_node, runtime_idx):
         old_key = (old_node, runtime_idx)
@@ -30,25 +79,17 @@ class TTFTWindowedOverloadedDetector:
 
     def calculate_half_window_averages(self, key):
         """ Calculate averages for the first and second halves of the window. """
-        first_half = []
-        second_half = []
-        half_window_cutoff = datetime.now() - self.half_window_duration
         if key not in self.data:
             return None, None
-        for timestamp, value in self.data[key]:
-            if timestamp < half_window_cutoff:
-                first_half.append(value)
-            else:
-                second_half.append(value)
-        if len(first_half) == 0:
+        series = self.data[key]
+        series.advance(time.monotonic() - self.half_window_duration)
+        if not series.first_half or not series.second_half:
             return None, None
-        if len(second_half) == 0:
-            return  None, None
-        avg_first_half = sum(first_half) / len(first_half) if first_half else 0
-        avg_second_half = sum(second_half) / len(second_half) if second_half else 0
+        avg_first_half = series.first_sum / len(series.first_half)
+        avg_second_half = series.second_sum / len(series.second_half)
 
         return avg_first_half, avg_second_half
-    
+
     def delete_after_allocation(self, node, gpu):
         key = (node, gpu)
         if key in self.data: